@@ -0,0 +1,106 @@
+import json
+import math
+import os
+import time
+from container_manager import ContainerManager
+from docker_hosts import DockerHosts
+from threading import Event, Thread
+
+
+class BuildScheduler:
+
+    # Low relative CPU weight for build containers, the default is 1024
+    container_limits = {'cpushares': 128}
+
+    def __init__(self, settings, profiles, window=0):
+        self.settings = settings
+        self.profiles = profiles
+        self.window = window * 60
+        self.stop_event = Event()
+        self.docker_hosts = DockerHosts(self.settings)
+
+        self.durations_path = self.settings['configdir'] + 'build_durations.json'
+        # Durations per image and host, e.g. {"rocked_firefox": {"unix:///var/run/docker.sock": 312.5}}
+        self.durations = dict()
+        if os.path.isfile(self.durations_path):
+            with open(self.durations_path, 'r') as json_file:
+                self.durations = {image_name: hosts for image_name, hosts in json.load(json_file).items() if isinstance(hosts, dict)}
+
+
+    def run_once(self):
+        start = time.monotonic()
+
+        reachable_hosts = self.docker_hosts.get_reachable_hosts()
+
+        stale_builds = list()
+        for profile in self.profiles:
+            try:
+                manager = ContainerManager(self.settings, profile, self.docker_hosts)
+            except Exception as error:
+                print('\nProfile "' + profile['name'] + '" skipped: ' + repr(error))
+                continue
+
+            for host in reachable_hosts:
+                manager.use_host(host)
+                try:
+                    # Like update, only refresh images that exist on the host
+                    if manager.exists_image() and manager.is_image_stale():
+                        stale_builds.append((manager, host))
+                except Exception as error:
+                    print('\nCheck of "' + manager.image_name + '" on "' + host + '" failed: ' + repr(error))
+
+        # Longest builds first, profiles without a recorded duration count as longest
+        stale_builds.sort(key=lambda build: self.__get_duration(*build, default=math.inf), reverse=True)
+
+        for manager, host in stale_builds:
+            if self.stop_event.is_set():
+                return
+
+            duration = self.__get_duration(manager, host, default=0)
+            if self.window and time.monotonic() - start + duration > self.window:
+                print('\nSkip build of "' + manager.image_name + '" on "' + host + '", it does not fit into the maintenance window.')
+                continue
+
+            print('\nPrebuild image "' + manager.image_name + '" on "' + host + '".')
+            manager.use_host(host)
+            build_start = time.monotonic()
+            # A failed build must not stop the remaining builds or the periodic thread
+            try:
+                image_id = manager.prebuild_image(container_limits=self.container_limits)
+            except Exception as error:
+                print('\nPrebuild of "' + manager.image_name + '" on "' + host + '" failed: ' + repr(error))
+                continue
+
+            if image_id is not None:
+                self.durations.setdefault(manager.image_name, dict())[host] = time.monotonic() - build_start
+                self.__save_durations()
+
+
+    def __get_duration(self, manager, host, default):
+        return self.durations.get(manager.image_name, dict()).get(host, default)
+
+
+    def __save_durations(self):
+        tmp_path = self.durations_path + '.tmp'
+        with open(tmp_path, 'w') as json_file:
+            json.dump(self.durations, json_file, indent=4)
+        os.replace(tmp_path, self.durations_path)
+
+
+    def start(self, interval):
+        thread = Thread(target=self.__run_periodically, args=(interval * 60,), daemon=True)
+        thread.start()
+        return thread
+
+
+    def stop(self):
+        self.stop_event.set()
+
+
+    def __run_periodically(self, interval):
+        while not self.stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as error:
+                print('\nPrebuild run failed: ' + repr(error))
+            self.stop_event.wait(interval)
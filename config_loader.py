@@ -1,4 +1,5 @@
 import crypt
+import os
 import re
 import subprocess
 import sys
@@ -15,6 +16,9 @@ class ConfigLoader():
         self.is_updated = False
         print('Loading Config...\n')
 
+        # Configs from before multi host support lack the hosts setting
+        self.config['settings'].setdefault('hosts', None)
+
         user_updated = False
         for key, value in self.config['settings'].items():
             if value is None or setup:
@@ -32,6 +36,11 @@ class ConfigLoader():
                     self.__ask_secret()
                 elif key == 'gpu':
                     self.__detect_gpu()
+                elif key == 'hosts':
+                    self.__detect_hosts()
+
+        if not self.config['settings']['hosts']:
+            sys.exit('Config error: "hosts" must list at least one docker host, e.g. "unix:///var/run/docker.sock".')
 
     def __ask_secret(self):
         while True:
@@ -110,6 +119,11 @@ class ConfigLoader():
             print('Found GPU, using driver ' + driver + ' for rendering!\n')
             self.config['settings']['gpu'] = driver
 
+    def __detect_hosts(self):
+        host = os.environ.get('DOCKER_HOST', 'unix:///var/run/docker.sock')
+        self.config['settings']['hosts'] = [host]
+        print('Docker hosts updated to ' + str(self.config['settings']['hosts']) + '.\n')
+
     def get_profile(self, profile_name):
         for profile in self.config['profiles']:
             if profile['name'] == profile_name:
@@ -1,4 +1,5 @@
 import docker
+import fcntl
 import filecmp
 import jinja2
 import json
@@ -9,19 +10,34 @@ import shlex
 import shutil
 import socket
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from docker_hosts import DockerHosts
 
 
 class ContainerManager:
 
-    def __init__(self, settings, profile):
+    def __init__(self, settings, profile, docker_hosts=None):
         self.profile = profile
         self.settings = settings
 
+        self.display_id = ''
+        self.hostip = ''
+        # Background builds run without a display
+        if 'DISPLAY' in os.environ:
+            self.__setup_display()
+
+        self.image_name = 'rocked_' + profile['name']
+
+        self.docker_hosts = docker_hosts or DockerHosts(self.settings)
+        self.hosts = self.docker_hosts.hosts
+        self.index = self.docker_hosts.index
+        self.host = self.hosts[0]
+
+
+    def __setup_display(self):
         display = os.environ['DISPLAY']
         display_split = display.split(':')
 
-        self.display_id = ''
-        self.hostip = ''
         if display_split[0]:
             self.display_id = display_split[1].split('.')[0]
             self.hostip = self.__get_hostip()
@@ -30,9 +46,6 @@ class ContainerManager:
         self.settings['display'] = display
         self.settings['cookies'] = self.__get_xauth_cookie()
 
-        self.image_name = 'rocked_' + profile['name']
-        self.client = docker.from_env()
-
 
     def __get_hostip(self):
         # Connect to dummy IP to get the hostIP
@@ -43,6 +56,79 @@ class ContainerManager:
         return host_ip
 
 
+    @property
+    def client(self):
+        return self.docker_hosts.get_client(self.host)
+
+
+    def use_host(self, host):
+        self.host = host
+
+
+    def get_host(self, container_id):
+        container_name = self.image_name + '_' + container_id
+        host = self.index.get(container_name)
+        if host in self.hosts:
+            return host
+
+
+    def __find_host(self, container_id):
+        host = self.get_host(container_id)
+        if host is None:
+            # Unknown container, refresh the index from all hosts
+            self.list_containers()
+            host = self.get_host(container_id)
+        return host
+
+
+    def select_host(self, container_id, refresh=True):
+        host = self.__find_host(container_id) if refresh else self.get_host(container_id)
+        if host is None:
+            host = self.__least_loaded_host()
+            if host is None:
+                print('\nNo local docker host reachable!')
+                return
+        elif not self.docker_hosts.is_local(host):
+            print('\nWarning: Container runs on remote docker host "' + host + '", display, sound, devices and volumes are not shared with this machine!')
+
+        print('\nUsing docker host "' + host + '".')
+        self.use_host(host)
+        return host
+
+
+    def __least_loaded_host(self):
+        # X11, pulse, /dev/dri and volumedir are bind mounted from the daemon's filesystem,
+        # so new containers are only placed on docker hosts of this machine
+        local_hosts = [host for host in self.hosts if self.docker_hosts.is_local(host)]
+        infos = self.docker_hosts.call_all(lambda client: client.info(), local_hosts)
+
+        reachable_hosts = [host for host, info in infos.items() if info is not None]
+        if not reachable_hosts:
+            return
+
+        # Fewest running containers first, most memory breaks ties
+        return min(reachable_hosts, key=lambda host: (infos[host]['ContainersRunning'], -infos[host]['MemTotal']))
+
+
+    def fan_out(self, function, container_ids):
+        groups = dict()
+        for container_id in container_ids:
+            host = self.get_host(container_id) or self.host
+            groups.setdefault(host, list()).append(container_id)
+
+        if not groups:
+            return
+
+        def run_group(group):
+            for container_id in group:
+                function(container_id)
+
+        # One worker per host, containers of the same host are handled sequentially
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            for future in [executor.submit(run_group, group) for group in groups.values()]:
+                future.result()
+
+
     def exists_image(self):
         try:
             self.client.images.get(self.image_name)
@@ -62,9 +148,21 @@ class ContainerManager:
         return self.image_name
 
 
-    def build_image(self, nocache=False, pull=False):
+    def build_image(self, nocache=False, pull=False, tag=None, container_limits=None):
         print('\nBuild Image: ' + str(self.profile) + '\n')
 
+        # Builds share the tmp dir as build context, serialize them with a lock
+        os.makedirs(self.settings['configdir'] + 'tmp/', exist_ok=True)
+        with open(self.settings['configdir'] + 'build.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            image_id = self.__build_image(nocache, pull, tag or self.image_name, container_limits)
+
+        if image_id:
+            return image_id
+        print('\nImage "' + self.image_name + '" could not be built!')
+
+
+    def __build_image(self, nocache, pull, tag, container_limits):
         template_dir = self.settings['configdir'] + 'templates/' + self.profile['distro'] + '/'
         jinja_loader = jinja2.FileSystemLoader(searchpath=template_dir)
         jinja_env = jinja2.Environment(loader=jinja_loader)
@@ -92,7 +190,7 @@ class ContainerManager:
         with open(dockerfile_path, 'w') as f:
             f.write('\n'.join(docker_layers))
 
-        log = self.client.api.build(path=self.settings['configdir'] + 'tmp/', tag='rocked_' + self.profile['name'], nocache=nocache, pull=pull, forcerm=True, decode=True)
+        log = self.client.api.build(path=self.settings['configdir'] + 'tmp/', tag=tag, nocache=nocache, pull=pull, forcerm=True, decode=True, container_limits=container_limits)
 
         image_id = ''
         for chunk in log:
@@ -106,10 +204,51 @@ class ContainerManager:
         os.remove(dockerfile_path)
         if entryscript_path:
             os.remove(entryscript_path)
+        return image_id
 
-        if image_id:
-            return image_id
-        print('\nImage "' + self.image_name + '" could not be built!')
+
+    def is_image_stale(self):
+        if not self.exists_image():
+            return True
+
+        try:
+            base_image = self.client.images.get(self.profile['baseimage'])
+        except docker.errors.ImageNotFound:
+            return True
+
+        # Image was not built on top of the local base image, e.g. the base image was pulled after the build
+        image = self.client.images.get(self.image_name)
+        base_layers = base_image.attrs['RootFS']['Layers']
+        if image.attrs['RootFS']['Layers'][:len(base_layers)] != base_layers:
+            return True
+
+        try:
+            registry_digest = self.client.images.get_registry_data(self.profile['baseimage']).id
+        except docker.errors.APIError:
+            print('\nRegistry data of base image "' + self.profile['baseimage'] + '" not available.')
+            return False
+
+        local_digests = [digest.split('@')[-1] for digest in base_image.attrs['RepoDigests']]
+        return registry_digest not in local_digests
+
+
+    def prebuild_image(self, container_limits=None):
+        image_id_old = ''
+        if self.exists_image():
+            image_id_old = self.client.images.get(self.image_name).id
+
+        # Build under a staging tag, so the image in use stays valid until the retag
+        staging_tag = self.image_name + ':prebuild'
+        image_id = self.build_image(pull=True, tag=staging_tag, container_limits=container_limits)
+        if image_id is None:
+            return
+
+        self.client.images.get(staging_tag).tag(self.image_name)
+        self.client.images.remove(staging_tag)
+
+        if image_id_old and image_id_old != self.client.images.get(self.image_name).id:
+            self.remove_image(image_id_old, only_untangled=True)
+        return image_id
 
 
     def __generate_entryscript(self):
@@ -146,9 +285,10 @@ class ContainerManager:
             shutil.copy2(process_dir + process_file, tmp_dir + process_file)
 
 
-    def exists_container(self,container_id):
+    def exists_container(self,container_id, refresh=True):
         container_name = self.image_name + '_' + container_id
-        return self.client.containers.get(container_name)
+        host = self.__find_host(container_id) if refresh else self.get_host(container_id)
+        return self.docker_hosts.get_client(host or self.host).containers.get(container_name)
 
 
     def create_container(self, container_id):
@@ -158,6 +298,7 @@ class ContainerManager:
             print(key + ': ' + str(value))
 
         container = self.client.containers.run(**run_dict)
+        self.index.set(container.name, self.host)
         self.__add_xauth(container)
         return container
 
@@ -207,7 +348,8 @@ class ContainerManager:
 
     def exec_container(self, container_id, command=''):
         try:
-            container = self.exists_container(container_id)
+            # The index was already refreshed when the host was selected
+            container = self.exists_container(container_id, refresh=False)
         except docker.errors.NotFound:
             print('\nContainer not found!')
             container = self.create_container(container_id)
@@ -217,9 +359,10 @@ class ContainerManager:
             container.start()
         self.__add_xauth(container)
 
-        docker_exec = jinja2.Template('docker exec -it -u {{ user }} {{ container }} {{ command }}')
+        docker_exec = jinja2.Template('docker -H {{ host }} exec -it -u {{ user }} {{ container }} {{ command }}')
         exec_command = 'process_reporter.sh ' + self.settings['display']
-        args = docker_exec.render(user=self.settings['user'], container=container.name, command=exec_command).split(' ')
+        host = self.get_host(container_id) or self.host
+        args = docker_exec.render(host=host, user=self.settings['user'], container=container.name, command=exec_command).split(' ')
 
         if not command:
             args += shlex.split(self.profile['run']['command'])
@@ -283,6 +426,7 @@ class ContainerManager:
         if container.status == 'exited':
             print('\nRemove container "' + container.name + '".')
             container.remove()
+            self.index.remove(container.name)
             return container.image.id
 
 
@@ -316,26 +460,37 @@ class ContainerManager:
         return self.image_name
 
 
-    def list_containers(self):
-        containers = self.client.containers.list(all=True)
-        related_container_ids = list()
-
+    def __update_host_containers(self, host, containers):
+        related_containers = dict()
         for container in containers:
-            result = re.match('^' + self.image_name + '_([0-9]+)', container.name)
+            result = re.match('^' + re.escape(self.image_name) + '_([0-9]+)$', container.name)
             if result is not None:
-                related_container_ids.append(result.groups()[0])
+                related_containers[container.name] = result.groups()[0]
+
+        self.index.update('^' + re.escape(self.image_name) + '_[0-9]+$', host, related_containers.keys())
+        return list(related_containers.values())
+
+
+    def list_containers(self):
+        host_containers = self.docker_hosts.call_all(lambda client: client.containers.list(all=True))
+
+        related_container_ids = list()
+        for host, containers in host_containers.items():
+            if containers is not None:
+                related_container_ids += self.__update_host_containers(host, containers)
         return related_container_ids
 
 
-    def remove_image(self, image_id, only_untangled=False):
+    def remove_image(self, image_id, only_untangled=False, host=None):
         if image_id is None:
             return
 
+        client = self.client if host is None else self.docker_hosts.get_client(host)
         try:
-            if only_untangled and not len(self.client.images.get(image_id).tags) == 0:
+            if only_untangled and not len(client.images.get(image_id).tags) == 0:
                 return
             print('\nRemove image "' + image_id + '"!')
-            self.client.images.remove(image_id)
+            client.images.remove(image_id)
         except docker.errors.ImageNotFound:
             print('\nImage "' + image_id + '" already removed.')
         except docker.errors.APIError as api_error:
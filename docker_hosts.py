@@ -0,0 +1,47 @@
+import docker
+import re
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from host_index import HostIndex
+
+
+class DockerHosts:
+
+    def __init__(self, settings):
+        self.hosts = settings['hosts']
+        self.clients = dict()
+        self.index = HostIndex(settings['configdir'] + 'hosts.json')
+
+
+    # Clients are created on first use, the docker SDK contacts the daemon on creation
+    def get_client(self, host):
+        if host not in self.clients:
+            self.clients[host] = docker.DockerClient(base_url=host)
+        return self.clients[host]
+
+
+    def is_local(self, host):
+        return host.startswith('unix://') or re.match('^tcp://(localhost|127\.0\.0\.1)(:[0-9]+)?/?$', host) is not None
+
+
+    def call(self, host, function):
+        try:
+            return function(self.get_client(host))
+        except (docker.errors.DockerException, requests.exceptions.ConnectionError):
+            print('\nDocker host "' + host + '" not reachable!')
+
+
+    def call_all(self, function, hosts=None):
+        if hosts is None:
+            hosts = self.hosts
+        if not hosts:
+            return dict()
+
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            results = executor.map(lambda host: self.call(host, function), hosts)
+            return dict(zip(hosts, results))
+
+
+    def get_reachable_hosts(self, hosts=None):
+        results = self.call_all(lambda client: client.ping(), hosts)
+        return [host for host, result in results.items() if result is not None]
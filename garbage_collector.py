@@ -0,0 +1,276 @@
+import docker
+import fcntl
+import jinja2
+import os
+import re
+import shutil
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from docker_hosts import DockerHosts
+
+
+class GarbageCollector:
+
+    categories = ('containers', 'images', 'volumes', 'tmp')
+
+    def __init__(self, settings, profiles, max_age=0, keep=0, jobs=4, containers=False, volumes=False):
+        self.settings = settings
+        self.profiles = profiles
+        self.jobs = jobs
+        self.containers = containers
+        self.volumes = volumes
+        self.max_age = max_age * 86400
+        self.now = time.time()
+
+        # Per profile policies override the command line defaults
+        self.policies = dict()
+        for profile in profiles:
+            policy = profile.get('gc', dict())
+            self.policies[profile['name']] = {
+                'max_age': policy.get('max_age', max_age) * 86400,
+                'keep': policy.get('keep', keep)
+            }
+
+        self.docker_hosts = DockerHosts(self.settings)
+
+
+    def collect(self):
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(self.__collect_host, host) for host in self.docker_hosts.hosts]
+            if self.volumes:
+                futures.append(executor.submit(self.__collect_volumes))
+            futures.append(executor.submit(self.__collect_tmp))
+
+            candidates = list()
+            for future in futures:
+                candidates += future.result()
+        return self.__filter_used_images(self.__apply_container_policies(candidates))
+
+
+    def __apply_container_policies(self, candidates):
+        # Keep the newest stopped containers of each profile across all hosts
+        exited_containers = dict()
+        for candidate in candidates:
+            if candidate['category'] == 'containers':
+                exited_containers.setdefault(candidate['profile'], list()).append(candidate)
+
+        removable_containers = list()
+        for profile_name, containers in exited_containers.items():
+            policy = self.policies[profile_name]
+            containers = sorted(containers, key=lambda container: container['finished'], reverse=True)
+            for container in containers[policy['keep']:]:
+                if self.now - container['finished'] >= policy['max_age']:
+                    removable_containers.append(container)
+
+        return [candidate for candidate in candidates if candidate['category'] != 'containers'] + removable_containers
+
+
+    def __filter_used_images(self, candidates):
+        # Untagged images are still in use by containers that are not removed, e.g. after an update
+        removed_containers = Counter((candidate['host'], candidate['image']) for candidate in candidates if candidate['category'] == 'containers')
+        return [candidate for candidate in candidates if candidate['category'] != 'images' or candidate['containers'] <= removed_containers[(candidate['host'], candidate['id'])]]
+
+
+    def __get_finished(self, client, container):
+        # Stopped containers are user state, their age counts from when they stopped
+        try:
+            finished_at = client.api.inspect_container(container['Id'])['State']['FinishedAt']
+        except docker.errors.NotFound:
+            return
+        if finished_at.startswith('0001-'):
+            return container['Created']
+        return datetime.strptime(finished_at[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+
+
+    def __collect_host(self, host):
+        usage = self.docker_hosts.call(host, lambda client: client.df())
+        if usage is None:
+            return list()
+
+        candidates = list()
+        for container in usage['Containers'] or list():
+            if not self.containers or container['State'] not in ('exited', 'created', 'dead'):
+                continue
+            result = re.match('^/rocked_(.*)_([0-9]+)$', container['Names'][0])
+            if result is None or result.groups()[0] not in self.policies:
+                continue
+            finished = self.docker_hosts.call(host, lambda client: self.__get_finished(client, container))
+            if finished is None:
+                continue
+            candidates.append({
+                'category': 'containers',
+                'host': host,
+                'id': container['Id'],
+                'name': container['Names'][0].lstrip('/'),
+                'image': container['ImageID'],
+                'profile': result.groups()[0],
+                'finished': finished,
+                'size': container.get('SizeRw', 0)
+            })
+
+        for image in usage['Images'] or list():
+            if image['RepoTags'] and image['RepoTags'] != ['<none>:<none>']:
+                continue
+            if self.now - image['Created'] < self.max_age:
+                continue
+            candidates.append({
+                'category': 'images',
+                'host': host,
+                'id': image['Id'],
+                'name': image['Id'].split(':')[-1][:12],
+                'containers': max(image.get('Containers', 0), 0),
+                'size': image['Size'] - max(image.get('SharedSize', -1), 0)
+            })
+        return candidates
+
+
+    def __get_used_paths(self):
+        # Volume sources of all profiles, rendered like in ContainerManager.__merge_run
+        used_paths = [os.path.realpath(self.settings['volumedir'] + profile['name']) for profile in self.profiles]
+        for profile in self.profiles:
+            for volume in profile.get('run', dict()).get('volumes', list()):
+                src_path = jinja2.Template(volume).render(settings=self.settings, profile=profile).split(':')[0]
+                used_paths.append(os.path.realpath(src_path))
+
+        # The rocked checkout itself may live in the volume dir
+        used_paths.append(os.path.realpath(os.path.dirname(os.path.abspath(__file__))))
+        return used_paths
+
+
+    def __collect_volumes(self):
+        volume_dir = os.path.realpath(self.settings['volumedir'])
+        if not os.path.isdir(volume_dir):
+            return list()
+
+        used_paths = self.__get_used_paths()
+        candidates = list()
+        for entry in os.scandir(volume_dir):
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            path = os.path.realpath(entry.path)
+            if os.path.dirname(path) != volume_dir:
+                continue
+            if any(used_path == path or used_path.startswith(path + os.sep) for used_path in used_paths):
+                continue
+
+            size, mtime = self.__get_dir_usage(path)
+            if self.now - mtime < self.max_age:
+                continue
+            candidates.append({'category': 'volumes', 'name': path, 'size': size})
+        return candidates
+
+
+    def __lock_builds(self):
+        # Builds use the tmp dir as build context, skip it while a build holds the lock
+        lock_file = open(self.settings['configdir'] + 'build.lock', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            print('\nBuild in progress, skipping tmp files.')
+            return
+        return lock_file
+
+
+    def __collect_tmp(self):
+        tmp_dir = self.settings['configdir'] + 'tmp/'
+        if not os.path.isdir(tmp_dir):
+            return list()
+
+        lock_file = self.__lock_builds()
+        if lock_file is None:
+            return list()
+
+        candidates = list()
+        with lock_file:
+            for entry in os.scandir(tmp_dir):
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat = entry.stat()
+                if self.now - stat.st_mtime < self.max_age:
+                    continue
+                candidates.append({'category': 'tmp', 'name': entry.path, 'size': stat.st_size})
+        return candidates
+
+
+    def __get_dir_usage(self, path):
+        # Size and newest modification time of everything below the path
+        size = 0
+        mtime = os.stat(path).st_mtime
+        for dirpath, _, filenames in os.walk(path):
+            mtime = max(mtime, os.stat(dirpath).st_mtime)
+            for filename in filenames:
+                file_path = os.path.join(dirpath, filename)
+                if not os.path.islink(file_path):
+                    stat = os.stat(file_path)
+                    size += stat.st_size
+                    mtime = max(mtime, stat.st_mtime)
+        return size, mtime
+
+
+    def report(self, candidates):
+        print('\nReclaimable space:')
+        for category in self.categories:
+            category_candidates = [candidate for candidate in candidates if candidate['category'] == category]
+            size = sum(candidate['size'] for candidate in category_candidates)
+            print('    ' + category.capitalize() + ': ' + self.__format_size(size) + ' (' + str(len(category_candidates)) + ')')
+            for candidate in category_candidates:
+                host = ' on ' + candidate['host'] if 'host' in candidate else ''
+                print('        ' + candidate['name'] + host + ': ' + self.__format_size(candidate['size']))
+        print('    Total: ' + self.__format_size(sum(candidate['size'] for candidate in candidates)))
+
+
+    def __format_size(self, size):
+        for unit in ('B', 'KB', 'MB', 'GB'):
+            if size < 1000:
+                return '{:.1f} {}'.format(size, unit)
+            size /= 1000
+        return '{:.1f} TB'.format(size)
+
+
+    def delete(self, candidates):
+        # Remove containers first, so images they used can be removed in the same run
+        containers = [candidate for candidate in candidates if candidate['category'] == 'containers']
+        others = [candidate for candidate in candidates if candidate['category'] not in ('containers', 'tmp')]
+        tmp_files = [candidate for candidate in candidates if candidate['category'] == 'tmp']
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for phase in (containers, others):
+                list(executor.map(self.__delete_candidate, phase))
+
+        if not tmp_files:
+            return
+        lock_file = self.__lock_builds()
+        if lock_file is None:
+            return
+        with lock_file:
+            for candidate in tmp_files:
+                self.__delete_candidate(candidate)
+
+
+    def __delete_candidate(self, candidate):
+        category = candidate['category']
+        print('\nRemove ' + category.rstrip('s') + ' "' + candidate['name'] + '".')
+
+        try:
+            if category == 'containers':
+                self.docker_hosts.get_client(candidate['host']).api.remove_container(candidate['id'])
+                self.docker_hosts.index.remove(candidate['name'])
+            elif category == 'images':
+                self.docker_hosts.get_client(candidate['host']).api.remove_image(candidate['id'])
+            elif category == 'volumes':
+                volume_dir = os.path.realpath(self.settings['volumedir'])
+                if os.path.dirname(os.path.realpath(candidate['name'])) != volume_dir:
+                    print('\n"' + candidate['name'] + '" is outside of the volume dir, skipped.')
+                    return
+                shutil.rmtree(candidate['name'])
+            elif category == 'tmp':
+                os.remove(candidate['name'])
+        except docker.errors.NotFound:
+            print('\n"' + candidate['name'] + '" already removed.')
+        except docker.errors.APIError as api_error:
+            print('\n"' + candidate['name'] + '" could not be removed: ' + str(api_error))
+        except OSError as os_error:
+            print('\n"' + candidate['name'] + '" could not be removed: ' + str(os_error))
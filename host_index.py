@@ -0,0 +1,55 @@
+import json
+import os
+import re
+from threading import Lock
+
+
+class HostIndex:
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.lock = Lock()
+        self.entries = dict()
+
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as json_file:
+                self.entries = json.load(json_file)
+
+
+    def get(self, container_name):
+        with self.lock:
+            return self.entries.get(container_name)
+
+
+    def set(self, container_name, host):
+        with self.lock:
+            if self.entries.get(container_name) == host:
+                return
+            self.entries[container_name] = host
+            self.__save()
+
+
+    def remove(self, container_name):
+        with self.lock:
+            if self.entries.pop(container_name, None) is not None:
+                self.__save()
+
+
+    def update(self, pattern, host, container_names):
+        # Replace all entries matching the pattern on the host by the names that were found there
+        with self.lock:
+            entries = {name: entry for name, entry in self.entries.items() if not (re.match(pattern, name) and entry == host)}
+            for container_name in container_names:
+                entries[container_name] = host
+
+            if entries != self.entries:
+                self.entries = entries
+                self.__save()
+
+
+    def __save(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as json_file:
+            json.dump(self.entries, json_file, indent=4)
+        os.replace(tmp_path, self.index_path)
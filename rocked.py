@@ -5,8 +5,10 @@ import argcomplete
 import argparse
 import json
 import sys
+from build_scheduler import BuildScheduler
 from config_loader import ConfigLoader
 from container_manager import ContainerManager
+from garbage_collector import GarbageCollector
 
 
 def generate_choices(config_path):
@@ -18,6 +20,12 @@ def generate_choices(config_path):
             choices.append(profile['name'])
     return choices
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return number
+
 def handle_args(profile_choices):
     parser = argparse.ArgumentParser(prog='rocked',
                                      usage='%(prog)s [options] command',
@@ -49,6 +57,18 @@ def handle_args(profile_choices):
     destroy_parser = subparsers.add_parser('destroy', help='Remove all containers and images that belong to the profile')
     destroy_parser.add_argument('profile', help='Profile of container', choices=profile_choices)
 
+    gc_parser = subparsers.add_parser('gc', help='Remove dangling images, stopped containers, orphaned volumes and tmp files')
+    gc_parser.add_argument('-d', '--dry-run', action='store_true', help='Only report reclaimable space')
+    gc_parser.add_argument('-m', '--max-age', type=int, default=0, help='Minimum age in days, stopped containers count from when they stopped')
+    gc_parser.add_argument('-k', '--keep', type=int, default=0, help='Number of stopped containers kept per profile')
+    gc_parser.add_argument('-j', '--jobs', type=positive_int, default=4, help='Number of parallel deletions')
+    gc_parser.add_argument('-c', '--containers', action='store_true', help='Also remove stopped containers')
+    gc_parser.add_argument('-v', '--volumes', action='store_true', help='Also remove volume directories not used by any profile')
+
+    prebuild_parser = subparsers.add_parser('prebuild', help='Rebuild stale images of all profiles in the background')
+    prebuild_parser.add_argument('-w', '--window', type=int, default=0, help='Maintenance window in minutes')
+    prebuild_parser.add_argument('-i', '--interval', type=int, default=0, help='Check interval in minutes, run once if not set')
+
     argcomplete.autocomplete(parser)
     args, unknown = parser.parse_known_args()
 
@@ -84,6 +104,28 @@ def main():
     if setup:
         return
 
+    if args.mode == 'gc':
+        collector = GarbageCollector(loader.get_settings(), loader.config['profiles'], max_age=args.max_age, keep=args.keep, jobs=args.jobs, containers=args.containers, volumes=args.volumes)
+        candidates = collector.collect()
+        collector.report(candidates)
+        if not args.dry_run:
+            collector.delete(candidates)
+        return
+
+    if args.mode == 'prebuild':
+        scheduler = BuildScheduler(loader.get_settings(), loader.config['profiles'], window=args.window)
+        if not args.interval:
+            scheduler.run_once()
+            return
+
+        thread = scheduler.start(args.interval)
+        try:
+            while thread.is_alive():
+                thread.join(1)
+        except KeyboardInterrupt:
+            scheduler.stop()
+        return
+
     profile = loader.get_profile(args.profile)
     if profile is None:
         print('Profile with name "' + args.profile + '" not found!')
@@ -92,9 +134,7 @@ def main():
     manager = ContainerManager(loader.get_settings(), profile)
 
     if args.mode == 'open':
-        if not manager.exists_image():
-            if manager.build_image() is None:
-                return
+        container_id = args.id
         if args.new:
             container_ids = manager.list_containers()
             container_ids.append('-1')
@@ -104,36 +144,54 @@ def main():
                 if (container_ids[i] - container_ids[i-1]) > 1:
                     container_id = container_ids[i-1] + 1
                     break
-            manager.exec_container(str(container_id), args.command)
-        else:
-            manager.exec_container(args.id, args.command)
+            container_id = str(container_id)
+
+        # Ids picked by --new come from a fresh list_containers(), no need to refresh the index again
+        if manager.select_host(container_id, refresh=not args.new) is None:
+            return
+        if not manager.exists_image():
+            if manager.build_image() is None:
+                return
+        manager.exec_container(container_id, args.command)
     elif args.mode == 'close':
         if args.all:
-            container_ids, _ = manager.list_containers()
-            for container_id in container_ids:
-                manager.stop_container(container_id)
+            manager.fan_out(manager.stop_container, manager.list_containers())
         else:
             manager.stop_container(args.id)
     elif args.mode == 'remove':
+        def remove(container_id):
+            # stop_container refreshes the index for unknown containers, look up the host afterwards
+            manager.stop_container(container_id)
+            host = manager.get_host(container_id)
+            image_id = manager.remove_container(container_id)
+            manager.remove_image(image_id, only_untangled=True, host=host)
+
         if args.all:
-            container_ids = manager.list_containers()
-            for container_id in container_ids:
-                manager.stop_container(container_id)
-                image_id = manager.remove_container(container_id)
-                manager.remove_image(image_id, only_untangled=True)
+            manager.fan_out(remove, manager.list_containers())
         else:
-            manager.stop_container(args.id)
-            image_id = manager.remove_container(args.id)
-            manager.remove_image(image_id, only_untangled=True)
+            remove(args.id)
     elif args.mode == 'update':
-        manager.update_image(force=args.force)
+        # Update the image on every host that has it, build it on the first host otherwise
+        reachable_hosts = manager.docker_hosts.get_reachable_hosts()
+        hosts = list()
+        for host in reachable_hosts:
+            manager.use_host(host)
+            if manager.exists_image():
+                hosts.append(host)
+
+        for host in hosts or reachable_hosts[:1]:
+            manager.use_host(host)
+            manager.update_image(force=args.force)
     elif args.mode == 'destroy':
-        container_ids = manager.list_containers()
-        for container_id in container_ids:
+        def destroy(container_id):
             manager.stop_container(container_id)
+            host = manager.get_host(container_id)
             image_id = manager.remove_container(container_id)
-            manager.remove_image(image_id)
-        manager.remove_image(manager.image_name)
+            manager.remove_image(image_id, host=host)
+
+        manager.fan_out(destroy, manager.list_containers())
+        for host in manager.docker_hosts.get_reachable_hosts():
+            manager.remove_image(manager.image_name, host=host)
 
 
 if __name__ == '__main__':